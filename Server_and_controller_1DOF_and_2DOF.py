@@ -5,6 +5,8 @@ import time
 import threading
 import csv
 import os
+import socket
+import struct
 from flask import Flask, request, jsonify
 from ServoPi import PWM
 
@@ -27,13 +29,30 @@ servo_params = {
     "hip2_min": 340, "hip2_max": 220, "hip2_phase": 0.0,
     "knee1_min": 450, "knee1_max": 320, "knee1_phase": 0.25,
     "knee2_min": 450, "knee2_max": 320, "knee2_phase": 0.25,
-    "speed": 0.0015
+    "speed": 0.0015,
+    "direction": 1,  # -1 plays the gait backwards
+    "heading_gain": 0.0  # 0 disables closed-loop heading correction
 }
 
 running = False  
 params_received = False  
 lock = threading.Lock()  
 
+# Monotonic start/stop timestamps of the current trial, reported back to the optimizer
+trial_times = {"start": None, "stop": None}
+
+# MoCap pose feedback from the optimizer host (UDP)
+FEEDBACK_PORT = 5005
+POSE_FORMAT = "<Idfff"  # sequence, host send time, x (mm), y (mm), yaw (rad)
+ACK_FORMAT = "<Id"      # sequence, host send time echoed back for latency measurement
+POSE_TIMEOUT = 0.2      # seconds without a pose before corrections are dropped
+MAX_CORRECTION = 0.5    # largest fraction of hip amplitude removed from one leg
+
+feedback = {
+    "heading": None, "target_heading": None, "correction": 0.0,
+    "packets": 0, "received_at": None
+}
+
 # Path to CSV log file for parameter logging
 LOG_FILE_PATH = "/home/morten/Dokumenter/robot_params_log.csv"
 
@@ -75,7 +94,7 @@ class MinMaxController:
         else:
             return int(alpha + np.sin(2 * np.pi * (t + self.phi)) * alpha + beta)
 
-    def set_servo_position(self):
+    def set_servo_position(self, t):
         pos = self.compute_position(t)
         pwm.set_pwm(self.channel, 0, pos)
 
@@ -102,7 +121,9 @@ def set_params():
             if key in data and data[key] is not None:
                 servo_params[key] = data[key]
     params_received = True
-    log_parameters(servo_params)
+    # Return-to-start gaits send "log": false to stay out of the candidate log
+    if data.get("log", True):
+        log_parameters(servo_params)
     return jsonify({"Status": "OK", "Message": "Parameters updated"}), 200
 
 @app.route("/start", methods=["POST"])
@@ -111,16 +132,47 @@ def start_robot():
     if not params_received:
         return jsonify({"Status": "Error", "Message": "Parameters not received yet"}), 400
     print("Starting robot with updated parameters.")
+    # An optional target heading steers the robot (used by the return-to-start gait)
+    data = request.get_json(silent=True) or {}
+    trial_times["start"] = None
+    trial_times["stop"] = None
+    feedback["target_heading"] = data.get("target_heading")
+    feedback["correction"] = 0.0
     running = True
     return jsonify({"Status": "OK", "Message": "Robot started"}), 200
 
 @app.route("/stop", methods=["POST"])
 def stop_robot():
     global running
+    if running:
+        trial_times["stop"] = time.monotonic()
     running = False
     set_idle_position()
     print("Robot stopped.")
-    return jsonify({"Status": "OK", "Message": "Robot stopped, ready for new parameters"}), 200
+    return jsonify({
+        "Status": "OK",
+        "Message": "Robot stopped, ready for new parameters",
+        "Trial Start": trial_times["start"],
+        "Trial Stop": trial_times["stop"]
+    }), 200
+
+# Monotonic clock of the Pi, used by the optimizer to estimate the clock offset
+@app.route("/clock", methods=["GET"])
+def clock():
+    return jsonify({"Status": "OK", "Monotonic": time.monotonic()}), 200
+
+# Latest heading feedback state, for checking the UDP link during a trial
+@app.route("/feedback", methods=["GET"])
+def feedback_status():
+    received_at = feedback["received_at"]
+    return jsonify({
+        "Status": "OK",
+        "Packets": feedback["packets"],
+        "Pose Age": None if received_at is None else time.monotonic() - received_at,
+        "Heading": feedback["heading"],
+        "Target Heading": feedback["target_heading"],
+        "Correction": feedback["correction"]
+    }), 200
 
 @app.route("/", methods=["GET"])
 def status():
@@ -131,6 +183,41 @@ def status():
         "Parameters Received": params_received
     }), 200
 
+# Receive poses from the optimizer host, echo an ack and update the heading correction.
+# Without a target heading from /start, the heading at the first pose of a trial
+# is held as the target.
+def feedback_loop():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(("0.0.0.0", FEEDBACK_PORT))
+    while True:
+        data, address = sock.recvfrom(64)
+        if len(data) != struct.calcsize(POSE_FORMAT):
+            continue
+        seq, sent, x, y, yaw = struct.unpack(POSE_FORMAT, data)
+        sock.sendto(struct.pack(ACK_FORMAT, seq, sent), address)
+
+        if running and feedback["target_heading"] is None:
+            feedback["target_heading"] = yaw
+        if feedback["target_heading"] is not None:
+            error = feedback["target_heading"] - yaw
+            error = np.arctan2(np.sin(error), np.cos(error))
+            correction = servo_params["heading_gain"] * error
+            feedback["correction"] = float(np.clip(correction, -MAX_CORRECTION, MAX_CORRECTION))
+        feedback["heading"] = yaw
+        feedback["packets"] += 1
+        feedback["received_at"] = time.monotonic()
+
+# Hip amplitude scale per leg. A positive correction shortens the left stride,
+# a negative one the right stride. Walking backwards the same asymmetry turns the
+# robot the other way, so the correction follows the gait direction.
+# Stale feedback gives no correction.
+def heading_scales():
+    received_at = feedback["received_at"]
+    if received_at is None or time.monotonic() - received_at > POSE_TIMEOUT:
+        return 1.0, 1.0
+    correction = feedback["correction"] * servo_params["direction"]
+    return 1.0 - max(0.0, -correction), 1.0 - max(0.0, correction)
+
 # Main robot loop running in a background thread
 def robot_loop():
     global running
@@ -141,22 +228,31 @@ def robot_loop():
         if not running:
             time.sleep(0.1)
             continue
+        if trial_times["start"] is None:
+            trial_times["start"] = time.monotonic()
+        hip1_scale, hip2_scale = heading_scales()
         with lock:
-            hip1_controller = MinMaxController(SERVO_HIP1, servo_params["hip1_min"], servo_params["hip1_max"], servo_params["hip1_phase"])
+            hip1_max = servo_params["hip1_min"] + (servo_params["hip1_max"] - servo_params["hip1_min"]) * hip1_scale
+            hip2_max = servo_params["hip2_min"] + (servo_params["hip2_max"] - servo_params["hip2_min"]) * hip2_scale
+            hip1_controller = MinMaxController(SERVO_HIP1, servo_params["hip1_min"], hip1_max, servo_params["hip1_phase"])
             knee1_controller = MinMaxController(SERVO_KNEE1, servo_params["knee1_min"], servo_params["knee1_max"], servo_params["knee1_phase"])
-            hip2_controller = MinMaxController(SERVO_HIP2, servo_params["hip2_min"], servo_params["hip2_max"], servo_params["hip2_phase"])
+            hip2_controller = MinMaxController(SERVO_HIP2, servo_params["hip2_min"], hip2_max, servo_params["hip2_phase"])
             knee2_controller = MinMaxController(SERVO_KNEE2, servo_params["knee2_min"], servo_params["knee2_max"], servo_params["knee2_phase"])
-            hip1_controller.set_servo_position()
-            knee1_controller.set_servo_position()
-            hip2_controller.set_servo_position()
-            knee2_controller.set_servo_position()
-            t += servo_params["speed"]
+            hip1_controller.set_servo_position(t)
+            knee1_controller.set_servo_position(t)
+            hip2_controller.set_servo_position(t)
+            knee2_controller.set_servo_position(t)
+            t += servo_params["speed"] * servo_params["direction"]
         time.sleep(servo_params["speed"])
 
 robot_thread = threading.Thread(target=robot_loop)
 robot_thread.daemon = True
 robot_thread.start()
 
+feedback_thread = threading.Thread(target=feedback_loop)
+feedback_thread.daemon = True
+feedback_thread.start()
+
 if __name__ == "__main__":
     app.run(host="0.0.0.0", port=5000)
     
@@ -5,6 +5,9 @@ import numpy as np
 from scipy.interpolate import make_interp_spline
 import time
 import random
+import socket
+import struct
+import argparse
 import requests
 import csv
 import matplotlib.pyplot as plt
@@ -16,6 +19,42 @@ SET_PARAMS_URL = f"http://{RASPBERRY_PI_IP}:5000/set_params"
 START_URL = f"http://{RASPBERRY_PI_IP}:5000/start"
 STOP_URL = f"http://{RASPBERRY_PI_IP}:5000/stop"
 STATUS_URL = f"http://{RASPBERRY_PI_IP}:5000/"
+CLOCK_URL = f"http://{RASPBERRY_PI_IP}:5000/clock"
+FEEDBACK_URL = f"http://{RASPBERRY_PI_IP}:5000/feedback"
+
+# MoCap pose feedback to the Pi (UDP), must match the server
+FEEDBACK_PORT = 5005
+POSE_FORMAT = "<Idfff"  # sequence, send time, x (mm), y (mm), yaw (rad)
+ACK_FORMAT = "<Id"      # sequence, send time echoed back by the Pi
+FAKE_CAPTURE_RATE = 100
+# Heading correction gain for trials, in hip amplitude fraction per rad of heading error.
+# The Pi clips the correction at 0.5, reached at ~30 degrees off with the default 1.0.
+# 0 runs the trials open-loop. Override with --heading-gain.
+HEADING_GAIN = 1.0
+FAKE_POLL_INTERVAL = 0.1  # how often the stand-in sender reads the Pi's correction
+FAKE_TURN_RATE = 0.5      # simulated yaw rate (rad/s) per unit of correction
+
+# Trial timing
+TRIAL_DURATION = 20
+CLOCK_SYNC_SAMPLES = 10
+CLOCK_TIMEOUT = 1.0
+HTTP_TIMEOUT = 5.0
+FRAME_MARGIN = 0.5
+TRIAL_ATTEMPTS = 3
+
+# MoCap measurement retries
+MOCAP_ATTEMPTS = 10    # 1 s stream windows waiting for a tracked frame
+MEASURE_ATTEMPTS = 5   # measure_pose calls before giving up
+
+# Return-to-start between trials (positions in mm)
+START_ZONE_TOLERANCE = 150
+START_HEADING_TOLERANCE = np.radians(30)
+RETURN_STEP_DURATION = 5        # longest approach burst (s)
+RETURN_MIN_STEP_DURATION = 1    # shortest approach burst (s)
+RETURN_ALIGN_DURATION = 2       # forward/backward bursts used to turn inside the zone (s)
+RETURN_MAX_STEPS = 12
+RETURN_HEADING_GAIN = 1.0       # steering gain sent to the Pi during the return
+FORWARD_YAW_OFFSET = 0.0        # walking direction of the forward gait relative to the body x axis (rad)
 
 distances = []
 
@@ -38,7 +77,21 @@ best_params = {
     "knee2_min": 450, "knee2_max": 320,
     "speed": 0.0015,
     "hip1_phase": 0.0, "hip2_phase": 0.5,
-    "knee1_phase": 0.0, "knee2_phase": 0.5
+    "knee1_phase": 0.0, "knee2_phase": 0.5,
+    "direction": 1, "heading_gain": HEADING_GAIN
+}
+
+# Gait used to walk the robot back to the start zone, played in reverse by default
+RETURN_PARAMS = {
+    "hip1_min": 340, "hip1_max": 220,
+    "hip2_min": 340, "hip2_max": 220,
+    "knee1_min": 450, "knee1_max": 320,
+    "knee2_min": 450, "knee2_max": 320,
+    "speed": 0.0015,
+    "hip1_phase": 0.0, "hip2_phase": 0.5,
+    "knee1_phase": 0.0, "knee2_phase": 0.5,
+    "direction": -1, "heading_gain": RETURN_HEADING_GAIN,
+    "log": False  # keep return bursts out of the Pi's parameter log
 }
 
 # Motion Capture connection
@@ -56,7 +109,7 @@ def create_body_index(xml_string):
         body_to_index[body.text.strip()] = index
     return body_to_index
 
-async def measure_position(connection, wanted_body):
+async def measure_pose(connection, wanted_body):
     try:
         xml_string = await connection.get_parameters(parameters=["6d"])
         body_index = create_body_index(xml_string)
@@ -66,16 +119,21 @@ async def measure_position(connection, wanted_body):
             return None
 
         position = None
+        heading = None
         attempt = 0
 
         def on_packet(packet):
-            nonlocal position
+            nonlocal position, heading
             _, bodies = packet.get_6d()
             wanted_index = body_index[wanted_body]
-            pos, _ = bodies[wanted_index]
+            pos, rot = bodies[wanted_index]
             position = np.array([pos.x, pos.y, pos.z])
+            heading = yaw_from_rotation(rot)
 
         while position is None or np.isnan(position).any():
+            if attempt == MOCAP_ATTEMPTS:
+                print(f"Body '{wanted_body}' not tracked after {attempt} attempts!")
+                return None
             attempt += 1
             print(f"Waiting for valid MoCap data... (Attempt {attempt})")
 
@@ -84,36 +142,350 @@ async def measure_position(connection, wanted_body):
             await connection.stream_frames_stop()
 
         print(f"Valid MoCap data received after {attempt} attempts: {position}")
-        return position
+        return position, heading
 
     except Exception as e:
-        print(f"Error in measure_position: {e}")
+        print(f"Error in measure_pose: {e}")
         return None
 
-async def track_distance(connection, wanted_body="mortenrobot", params=None):
-    print("Getting start position...")
-    start_position = None
-    while start_position is None:
-        start_position = await measure_position(connection, wanted_body)
+async def measure_pose_with_retries(connection, wanted_body, attempts=MEASURE_ATTEMPTS):
+    for _ in range(attempts):
+        pose = await measure_pose(connection, wanted_body)
+        if pose is not None:
+            return pose
+        await asyncio.sleep(1)
+    return None
+
+# Sends MoCap poses to the Pi and measures host->Pi latency from the acks it echoes
+# back, taken as half the UDP round trip of each pose packet. When the QTM capture
+# gap (laptop arrival time minus QTM capture time) is passed for a frame, the
+# capture-to-host delay is measured too. QTM and laptop clocks are not synchronized,
+# so that delay is relative to the fastest frame of the trial, and the end-to-end
+# figure is a lower bound missing the constant part of the QTM->laptop delay.
+class PoseForwarder:
+    def __init__(self, host=RASPBERRY_PI_IP, port=FEEDBACK_PORT):
+        self.address = (host, port)
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setblocking(False)
+        self.seq = 0
+        self.latencies = []
+        self.capture_gaps = []
+
+    def send(self, x, y, yaw, capture_gap=None):
+        if capture_gap is not None:
+            self.capture_gaps.append(capture_gap)
+        self.seq += 1
+        self.sock.sendto(struct.pack(POSE_FORMAT, self.seq, time.monotonic(), x, y, yaw), self.address)
+        self.read_acks()
+
+    def read_acks(self):
+        while True:
+            try:
+                data, _ = self.sock.recvfrom(64)
+            except (BlockingIOError, ConnectionResetError):
+                return
+            if len(data) != struct.calcsize(ACK_FORMAT):
+                continue
+            _, sent = struct.unpack(ACK_FORMAT, data)
+            self.latencies.append((time.monotonic() - sent) / 2)
+
+    def latency_stats(self):
+        self.read_acks()
+        if not self.latencies:
+            return None
+        latencies = np.array(self.latencies) * 1000
+        stats = {
+            "packets": self.seq,
+            "acks": len(latencies),
+            "mean_ms": latencies.mean(),
+            "p95_ms": np.percentile(latencies, 95),
+            "max_ms": latencies.max(),
+            "capture_mean_ms": None,
+            "end_to_end_mean_ms": None
+        }
+        if self.capture_gaps:
+            capture_delays = (np.array(self.capture_gaps) - min(self.capture_gaps)) * 1000
+            stats["capture_mean_ms"] = capture_delays.mean()
+            stats["end_to_end_mean_ms"] = stats["capture_mean_ms"] + stats["mean_ms"]
+        return stats
+
+    def reset(self):
+        self.read_acks()
+        self.seq = 0
+        self.latencies = []
+        self.capture_gaps = []
+
+def print_latency(forwarder):
+    stats = forwarder.latency_stats()
+    if stats is None:
+        print(f"No feedback acks received from the Pi ({forwarder.seq} poses sent)!")
+        return
+    print(f"Host->Pi feedback latency: mean {stats['mean_ms']:.1f} ms, p95 {stats['p95_ms']:.1f} ms, "
+          f"max {stats['max_ms']:.1f} ms ({stats['acks']}/{stats['packets']} acks)")
+    if stats["end_to_end_mean_ms"] is not None:
+        print(f"QTM->host delay: mean {stats['capture_mean_ms']:.1f} ms, "
+              f"end-to-end latency: mean {stats['end_to_end_mean_ms']:.1f} ms")
+
+# Heading around the vertical axis from a QTM rotation matrix (column-major)
+def yaw_from_rotation(rot):
+    return np.arctan2(rot.matrix[1], rot.matrix[0])
+
+def wrap_angle(angle):
+    return np.arctan2(np.sin(angle), np.cos(angle))
+
+# Offset between the Pi and laptop monotonic clocks (pi_time - laptop_time).
+# The sample with the shortest round trip gives the tightest bound on the offset.
+# Failed samples are skipped; returns None if no sample succeeded.
+def estimate_clock_offset(samples=CLOCK_SYNC_SAMPLES):
+    best_rtt = None
+    offset = None
+    for _ in range(samples):
+        t0 = time.monotonic()
+        try:
+            pi_time = requests.get(CLOCK_URL, timeout=CLOCK_TIMEOUT).json()["Monotonic"]
+        except (requests.RequestException, ValueError, KeyError) as e:
+            print(f"Clock sample failed: {e}")
+            continue
+        t1 = time.monotonic()
+        rtt = t1 - t0
+        if best_rtt is None or rtt < best_rtt:
+            best_rtt = rtt
+            offset = pi_time - (t0 + t1) / 2
+    if offset is None:
+        print("Could not read the Pi clock!")
+        return None
+    print(f"Clock offset to Pi: {offset:.4f} s (round trip {best_rtt * 1000:.1f} ms)")
+    return offset
+
+# Map QTM capture timestamps onto the laptop clock. The smallest arrival-minus-capture
+# gap of the trial is taken as the offset, which removes network and processing jitter
+# but leaves a constant skew equal to the fastest QTM->laptop delay (a few ms).
+def frame_times(frames):
+    host_offset = min(received - captured for captured, received, _ in frames)
+    return [(captured + host_offset, position) for captured, _, position in frames]
+
+# Displacement along x between the first and last MoCap frame inside [t_start, t_stop]
+def window_distance(frames, t_start, t_stop):
+    window = [position for t, position in frames if t_start <= t <= t_stop]
+    if len(window) < 2:
+        return None
+    return abs(window[-1][0] - window[0][0]) / 1000
+
+async def track_distance(connection, wanted_body="mortenrobot", params=None, forwarder=None, offset=None):
+    xml_string = await connection.get_parameters(parameters=["6d"])
+    body_index = create_body_index(xml_string)
+    if wanted_body not in body_index:
+        print(f"Body '{wanted_body}' not found in MoCap data!")
+        return None
+    wanted_index = body_index[wanted_body]
+
+    frames = []
+
+    def on_packet(packet):
+        _, bodies = packet.get_6d()
+        pos, rot = bodies[wanted_index]
+        position = np.array([pos.x, pos.y, pos.z])
+        if not np.isnan(position).any():
+            # QTM capture time (us) and laptop arrival time of the frame
+            captured = packet.timestamp / 1e6
+            received = time.monotonic()
+            frames.append((captured, received, position))
+            if forwarder is not None:
+                forwarder.send(pos.x, pos.y, yaw_from_rotation(rot), received - captured)
+
+    if offset is None:
+        offset = await asyncio.to_thread(estimate_clock_offset)
+    if offset is None:
+        return None
+
+    if forwarder is not None:
+        forwarder.reset()
 
-    print(f"Sending parameters: {params}")
-    requests.post(SET_PARAMS_URL, json=params)
+    streaming = False
+    try:
+        print(f"Sending parameters: {params}")
+        await asyncio.to_thread(requests.post, SET_PARAMS_URL, json=params, timeout=HTTP_TIMEOUT)
+
+        await connection.stream_frames(components=["6d"], on_packet=on_packet)
+        streaming = True
+
+        print("Starting the robot")
+        await asyncio.to_thread(requests.post, START_URL, timeout=HTTP_TIMEOUT)
+        await asyncio.sleep(TRIAL_DURATION)
+        print("Stopping the robot")
+        response = await asyncio.to_thread(requests.post, STOP_URL, timeout=HTTP_TIMEOUT)
+        trial = response.json()
+
+        await asyncio.sleep(FRAME_MARGIN)
+    except (requests.RequestException, ValueError) as e:
+        print(f"Trial failed: {e}")
+        # Make sure the robot is not left walking if /start got through
+        try:
+            await asyncio.to_thread(requests.post, STOP_URL, timeout=HTTP_TIMEOUT)
+        except requests.RequestException:
+            pass
+        return None
+    finally:
+        if streaming:
+            await connection.stream_frames_stop()
 
-    print("Starting the robot")
-    requests.post(START_URL)
-    await asyncio.sleep(20)
-    print("Stopping the robot")
-    requests.post(STOP_URL)
+    if forwarder is not None:
+        print_latency(forwarder)
+
+    if trial.get("Trial Start") is None or trial.get("Trial Stop") is None:
+        print("Pi did not report trial timestamps!")
+        return None
+    if len(frames) < 2:
+        print("No valid MoCap frames received during the trial!")
+        return None
 
-    print("Getting end position...")
-    end_position = None
-    while end_position is None:
-        end_position = await measure_position(connection, wanted_body)
+    # Convert the Pi timestamps to the laptop clock
+    t_start = trial["Trial Start"] - offset
+    t_stop = trial["Trial Stop"] - offset
+    distance = window_distance(frame_times(frames), t_start, t_stop)
+    if distance is None:
+        print(f"Not enough valid MoCap frames in the {t_stop - t_start:.2f} s trial window!")
+        return None
 
-    distance = abs(end_position[0] - start_position[0]) / 1000
-    print(f"The robot moved {distance:.2f} meters.")
+    print(f"The robot moved {distance:.2f} meters in {t_stop - t_start:.2f} s.")
     return distance
 
+def propose_params(best_params, T):
+    new_params = best_params.copy()
+
+    exploration_factor = max(0.2, T)
+    hip_scale = random.uniform(0.8 - exploration_factor, 1.2 + exploration_factor)
+    knee_scale = random.uniform(0.8 - exploration_factor, 1.2 + exploration_factor)
+
+    new_params["hip1_min"] = min(340, max(220, best_params["hip1_min"] * hip_scale))
+    new_params["hip1_max"] = min(340, max(220, best_params["hip1_max"] * hip_scale))
+    if new_params["hip1_max"] > new_params["hip1_min"]:
+        new_params["hip1_max"] = new_params["hip1_min"]
+
+    new_params["hip2_min"] = min(340, max(220, best_params["hip2_min"] * hip_scale))
+    new_params["hip2_max"] = min(340, max(220, best_params["hip2_max"] * hip_scale))
+    if new_params["hip2_max"] > new_params["hip2_min"]:
+        new_params["hip2_max"] = new_params["hip2_min"]
+
+    new_params["knee1_min"] = min(450, max(320, best_params["knee1_min"] * knee_scale))
+    new_params["knee1_max"] = min(450, max(320, best_params["knee1_max"] * knee_scale))
+    if new_params["knee1_max"] > new_params["knee1_min"]:
+        new_params["knee1_max"] = new_params["knee1_min"]
+
+    new_params["knee2_min"] = min(450, max(320, best_params["knee2_min"] * knee_scale))
+    new_params["knee2_max"] = min(450, max(320, best_params["knee2_max"] * knee_scale))
+    if new_params["knee2_max"] > new_params["knee2_min"]:
+        new_params["knee2_max"] = new_params["knee2_min"]
+
+    return new_params
+
+# One burst of the return gait. Poses are forwarded to the Pi so it can steer
+# towards target_yaw with the per-leg hip amplitude correction.
+async def return_burst(connection, wanted_index, forwarder, duration, target_yaw):
+    def on_packet(packet):
+        _, bodies = packet.get_6d()
+        pos, rot = bodies[wanted_index]
+        if not np.isnan(pos.x):
+            forwarder.send(pos.x, pos.y, yaw_from_rotation(rot))
+
+    await connection.stream_frames(components=["6d"], on_packet=on_packet)
+    try:
+        await asyncio.to_thread(requests.post, START_URL, json={"target_heading": float(target_yaw)}, timeout=HTTP_TIMEOUT)
+        await asyncio.sleep(duration)
+    finally:
+        try:
+            await asyncio.to_thread(requests.post, STOP_URL, timeout=HTTP_TIMEOUT)
+        finally:
+            await connection.stream_frames_stop()
+
+# Walk the robot back into the start zone: a circle around the start position in
+# the floor plane, facing the start heading. Outside the zone the robot steers
+# towards the start, walking forwards or backwards whichever needs the smaller turn,
+# and bursts are shortened as it gets close. Inside the zone but turned away, short
+# alternating forward/backward bursts steer to the start heading, turning the robot
+# with little net displacement.
+async def return_to_start(connection, start_position, start_heading, forwarder, wanted_body="mortenrobot"):
+    try:
+        body_index = create_body_index(await connection.get_parameters(parameters=["6d"]))
+    except Exception as e:
+        print(f"Error reading MoCap bodies: {e}")
+        return False
+    if wanted_body not in body_index:
+        print(f"Body '{wanted_body}' not found in MoCap data!")
+        return False
+    wanted_index = body_index[wanted_body]
+
+    return_params = RETURN_PARAMS.copy()
+    sent_direction = None
+    speed = None
+    approach_start = None
+
+    # The last pass only checks the pose after the final burst
+    for step in range(RETURN_MAX_STEPS + 1):
+        pose = await measure_pose_with_retries(connection, wanted_body)
+        if pose is None:
+            print("Lost track of the robot while returning to start!")
+            return False
+        position, yaw = pose
+
+        to_start = start_position[:2] - position[:2]
+        error = np.linalg.norm(to_start)
+        heading_error = wrap_angle(start_heading - yaw)
+        if error <= START_ZONE_TOLERANCE and abs(heading_error) <= START_HEADING_TOLERANCE:
+            print(f"Robot is back in the start zone ({error:.0f} mm, {np.degrees(heading_error):.0f} degrees from start).")
+            return True
+        if step == RETURN_MAX_STEPS:
+            break
+
+        # Walking speed from the previous approach burst sizes the next one
+        if approach_start is not None:
+            previous_position, previous_duration = approach_start
+            speed = np.linalg.norm(position[:2] - previous_position[:2]) / previous_duration
+        approach_start = None
+
+        if error <= START_ZONE_TOLERANCE:
+            direction = 1 if sent_direction != 1 else -1
+            target_yaw = start_heading
+            duration = RETURN_ALIGN_DURATION
+            print(f"Turning to start heading, {np.degrees(heading_error):.0f} degrees off (step {step + 1}/{RETURN_MAX_STEPS})")
+        else:
+            bearing = np.arctan2(to_start[1], to_start[0])
+            if abs(wrap_angle(bearing - (yaw + FORWARD_YAW_OFFSET))) <= np.pi / 2:
+                direction = 1
+                target_yaw = wrap_angle(bearing - FORWARD_YAW_OFFSET)
+            else:
+                direction = -1
+                target_yaw = wrap_angle(bearing + np.pi - FORWARD_YAW_OFFSET)
+            duration = RETURN_STEP_DURATION
+            if speed:
+                duration = float(np.clip(error / speed, RETURN_MIN_STEP_DURATION, RETURN_STEP_DURATION))
+            approach_start = (position, duration)
+            print(f"Returning to start, {error:.0f} mm away (step {step + 1}/{RETURN_MAX_STEPS})")
+
+        try:
+            if direction != sent_direction:
+                return_params["direction"] = direction
+                await asyncio.to_thread(requests.post, SET_PARAMS_URL, json=return_params, timeout=HTTP_TIMEOUT)
+                sent_direction = direction
+            await return_burst(connection, wanted_index, forwarder, duration, target_yaw)
+        except requests.RequestException as e:
+            print(f"Return burst failed: {e}")
+            return False
+
+    print("Could not return the robot to the start zone!")
+    return False
+
+# Walk back to the start zone and sync the clocks with the Pi at the same time,
+# so the next trial can start right away. Returns the clock offset for that trial.
+async def prepare_next_trial(connection, start_position, start_heading, forwarder):
+    returned, offset = await asyncio.gather(
+        return_to_start(connection, start_position, start_heading, forwarder),
+        asyncio.to_thread(estimate_clock_offset)
+    )
+    if not returned:
+        input("Move the robot back to the start zone and press Enter to continue...")
+    return offset
+
 async def optimize_gait():
     global best_params
 
@@ -131,41 +503,41 @@ async def optimize_gait():
     if connection is None:
         return
 
-    while iteration < max_iterations:
-        print(f"Iteration {iteration + 1}/{max_iterations}...")
-
-        new_params = best_params.copy()
-
-        exploration_factor = max(0.2, T)
-        hip_scale = random.uniform(0.8 - exploration_factor, 1.2 + exploration_factor)
-        knee_scale = random.uniform(0.8 - exploration_factor, 1.2 + exploration_factor)
-
-        new_params["hip1_min"] = min(340, max(220, best_params["hip1_min"] * hip_scale))
-        new_params["hip1_max"] = min(340, max(220, best_params["hip1_max"] * hip_scale))
-        if new_params["hip1_max"] > new_params["hip1_min"]:
-            new_params["hip1_max"] = new_params["hip1_min"]
-
-        new_params["hip2_min"] = min(340, max(220, best_params["hip2_min"] * hip_scale))
-        new_params["hip2_max"] = min(340, max(220, best_params["hip2_max"] * hip_scale))
-        if new_params["hip2_max"] > new_params["hip2_min"]:
-            new_params["hip2_max"] = new_params["hip2_min"]
+    print("Getting start zone position...")
+    start_pose = await measure_pose_with_retries(connection, "mortenrobot")
+    if start_pose is None:
+        print("Could not measure the start zone position!")
+        return
+    start_position, start_heading = start_pose
 
-        new_params["knee1_min"] = min(450, max(320, best_params["knee1_min"] * knee_scale))
-        new_params["knee1_max"] = min(450, max(320, best_params["knee1_max"] * knee_scale))
-        if new_params["knee1_max"] > new_params["knee1_min"]:
-            new_params["knee1_max"] = new_params["knee1_min"]
+    forwarder = PoseForwarder()
+    new_params = propose_params(best_params, T)
+    failed_attempts = 0
+    offset = None
 
-        new_params["knee2_min"] = min(450, max(320, best_params["knee2_min"] * knee_scale))
-        new_params["knee2_max"] = min(450, max(320, best_params["knee2_max"] * knee_scale))
-        if new_params["knee2_max"] > new_params["knee2_min"]:
-            new_params["knee2_max"] = new_params["knee2_min"]
+    while iteration < max_iterations:
+        print(f"Iteration {iteration + 1}/{max_iterations}...")
 
-        distance = await track_distance(connection, "mortenrobot", new_params)
+        distance = await track_distance(connection, "mortenrobot", new_params, forwarder, offset)
+
+        # A failed measurement is repeated, never logged as a result
+        if distance is None:
+            failed_attempts += 1
+            if failed_attempts < TRIAL_ATTEMPTS:
+                print(f"Measurement failed, repeating the trial ({failed_attempts}/{TRIAL_ATTEMPTS})...")
+            else:
+                print("Measurement failed repeatedly, skipping this candidate.")
+                failed_attempts = 0
+                new_params = propose_params(best_params, T)
+            offset = await prepare_next_trial(connection, start_position, start_heading, forwarder)
+            continue
+        failed_attempts = 0
 
         if distance > best_distance:
             best_distance = distance
             best_params = new_params.copy()
 
+        latency = forwarder.latency_stats() or {}
         result_row = [
             iteration + 1,
             new_params["hip1_min"], new_params["hip1_max"],
@@ -175,6 +547,8 @@ async def optimize_gait():
             new_params["hip1_phase"], new_params["hip2_phase"],
             new_params["knee1_phase"], new_params["knee2_phase"],
             new_params["speed"],
+            latency.get("mean_ms"), latency.get("p95_ms"),
+            latency.get("capture_mean_ms"), latency.get("end_to_end_mean_ms"),
             distance
         ]
 
@@ -188,13 +562,19 @@ async def optimize_gait():
         T *= 0.98
         iteration += 1
 
+        if iteration < max_iterations:
+            new_params = propose_params(best_params, T)
+            offset = await prepare_next_trial(connection, start_position, start_heading, forwarder)
+
     with open(log_file, mode="w", newline="") as file:
         writer = csv.writer(file)
         writer.writerow([
             "Iteration", "Hip1 Min", "Hip1 Max", "Hip2 Min", "Hip2 Max",
             "Knee1 Min", "Knee1 Max", "Knee2 Min", "Knee2 Max",
             "Hip1 Phase", "Hip2 Phase", "Knee1 Phase", "Knee2 Phase",
-            "Speed", "Distance"
+            "Speed", "Host-Pi Latency Mean (ms)", "Host-Pi Latency P95 (ms)",
+            "QTM-Host Delay Mean (ms)", "End-to-End Latency Mean (ms)",
+            "Distance"
         ])
         writer.writerows(csv_data)
 
@@ -204,13 +584,59 @@ async def optimize_gait():
             "Iteration", "Hip1 Min", "Hip1 Max", "Hip2 Min", "Hip2 Max",
             "Knee1 Min", "Knee1 Max", "Knee2 Min", "Knee2 Max",
             "Hip1 Phase", "Hip2 Phase", "Knee1 Phase", "Knee2 Phase",
-            "Speed", "Distance"
+            "Speed", "Host-Pi Latency Mean (ms)", "Host-Pi Latency P95 (ms)",
+            "QTM-Host Delay Mean (ms)", "End-to-End Latency Mean (ms)",
+            "Distance"
         ])
         writer.writerows(top_10_data)
 
     print(f"\nBest parameters: {best_params}, distance: {best_distance:.2f} meters.")
     plot_results(distances, log_file)
 
+# Stand-in for Qualisys: streams a simulated pose at the capture rate. The simulated
+# yaw drifts on its own and turns with the correction the Pi reports on /feedback,
+# so both the UDP link and the closed heading loop can be tested on the robot.
+async def fake_feedback_trial(params=None, heading_gain=HEADING_GAIN, duration=TRIAL_DURATION, rate=FAKE_CAPTURE_RATE):
+    forwarder = PoseForwarder()
+    params = (params or best_params).copy()
+    params["heading_gain"] = heading_gain
+    correction = 0.0
+    done = False
+
+    async def poll_correction():
+        nonlocal correction
+        while not done:
+            try:
+                state = (await asyncio.to_thread(requests.get, FEEDBACK_URL, timeout=CLOCK_TIMEOUT)).json()
+                correction = state["Correction"]
+            except (requests.RequestException, ValueError, KeyError) as e:
+                print(f"Could not read the Pi correction: {e}")
+            await asyncio.sleep(FAKE_POLL_INTERVAL)
+
+    await asyncio.to_thread(requests.post, SET_PARAMS_URL, json=params, timeout=HTTP_TIMEOUT)
+    await asyncio.to_thread(requests.post, START_URL, timeout=HTTP_TIMEOUT)
+    poll_task = asyncio.create_task(poll_correction())
+
+    x, y, yaw = 0.0, 0.0, 0.0
+    try:
+        start = time.monotonic()
+        while time.monotonic() - start < duration:
+            yaw += (0.05 + FAKE_TURN_RATE * correction) / rate + random.gauss(0, 0.002)
+            x += 20 / rate * np.cos(yaw)
+            y += 20 / rate * np.sin(yaw)
+            forwarder.send(x, y, yaw)
+            await asyncio.sleep(1 / rate)
+
+        done = True
+        await poll_task
+        state = (await asyncio.to_thread(requests.get, FEEDBACK_URL, timeout=CLOCK_TIMEOUT)).json()
+    finally:
+        done = True
+        await asyncio.to_thread(requests.post, STOP_URL, timeout=HTTP_TIMEOUT)
+    print(f"Pi feedback state: {state}")
+    print(f"Simulated heading drifted {np.degrees(yaw):.1f} degrees, {y:.0f} mm sideways.")
+    print_latency(forwarder)
+
 if __name__ == "__main__":
     start_params = {
         "hip1_min": 340, "hip1_max": 220,
@@ -219,9 +645,19 @@ if __name__ == "__main__":
         "knee2_min": 450, "knee2_max": 320,
         "speed": 0.0015,
         "hip1_phase": 0.0, "hip2_phase": 0.5,
-        "knee1_phase": 0.0, "knee2_phase": 0.5
+        "knee1_phase": 0.0, "knee2_phase": 0.5,
+        "direction": 1, "heading_gain": HEADING_GAIN
     }
-    asyncio.run(optimize_gait())
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--fake-feedback", action="store_true", help="test the feedback link with a simulated pose instead of Qualisys")
+    parser.add_argument("--heading-gain", type=float, default=HEADING_GAIN, help=f"heading correction gain for trials, 0 = open-loop (default {HEADING_GAIN})")
+    args = parser.parse_args()
+
+    best_params["heading_gain"] = args.heading_gain
+    if args.fake_feedback:
+        asyncio.run(fake_feedback_trial(heading_gain=args.heading_gain))
+    else:
+        asyncio.run(optimize_gait())
 
 def plot_results(distances, log_file):
     iterations = np.arange(1, len(distances) + 1)